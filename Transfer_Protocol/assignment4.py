@@ -6,30 +6,37 @@ from typing import Union
 import click as click
 
 import socket
-import re
 import sys
 
 
-BUFFER_SIZE = 1024
+BUFFER_SIZE = 65536  # bytes per recv
+RECEIVE_BUFFER_SIZE = BUFFER_SIZE * 2  # initial size of each NetstringReader buffer
+SOCKET_BUFFER_SIZE = 1 << 20  # kernel send/receive buffers
 TIME_OUT = 0.5
+DEBUG = False  # trace protocol traffic on stderr, set with -v
 
 
 def string_to_int(string: str) -> int:
     # "+5" and "05" are considered invalid
-    pattern = r'^[1-9]\d*$'
-    if not re.match(pattern, string):
+    if not string or string[0] < '1' or string[0] > '9' or not (string.isascii() and string.isdigit()):
+        return None
+    try:
+        return int(string)
+    except ValueError:  # more digits than int() accepts
         return None
-    return int(string)
 
 
-def string_to_netstring(string: str) -> str:
-    length = len(string.encode())
-    return f'{length}:{string},'
+def bytes_to_netstring(payload: bytes, prefix: bytes = b'') -> bytes:
+    # frame the whole netstring in one C-level formatting step,
+    # prefix is prepended to payload without copying payload separately
+    return b'%d:%s%s,' % (len(prefix) + len(payload), prefix, payload)
 
 
-# def bytes_to_netstring(bytes: bytes) -> bytes:
-#     length = len(bytes)
-#     return f'{length}:'.encode() + bytes + b','
+# static protocol messages, encoded once at import time
+INIT_NETSTRING = bytes_to_netstring(b'C GRNVS V:1.0')
+EXPECT_SERVER_HELLO = b'S GRNVS V:1.0'
+EXPECT_DATA_HELLO = b'T GRNVS V:1.0'
+EXPECT_ACK = b'S ACK'
 
 
 # def netstring_to_string(netstring: bytes) -> bytes:
@@ -44,186 +51,214 @@ def string_to_netstring(string: str) -> str:
 #     return string
     
     
-def send_error(error: str, sock: socket.socket):
-    sock.sendall(string_to_netstring(f'E {error}').encode())
+def set_nodelay(sock: socket.socket):
+    # the protocol is a ping-pong of tiny messages, Nagle would only hold them back
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    
+    
+def configure_socket(sock: socket.socket):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    set_nodelay(sock)
+    
+    
+def send_error(error: str, sock: socket.socket, exit_code: int = 0):
+    sock.sendall(bytes_to_netstring(b'E ' + error.encode()))
     print(f'Error: {error}')
     sock.close()
-    sys.exit()
+    sys.exit(exit_code)
+    
     
+def send_netstring(netstring: bytes, sock: socket.socket):
+    # netstring is already framed
+    if DEBUG:
+        sys.stderr.write('Sent: {}\n'.format(netstring))
+    sock.sendall(netstring)
     
-def send_message(message: str, sock: socket.socket):
-    sys.stderr.write('Sent: {}\n'.format(message))
-    sock.sendall(string_to_netstring(message).encode())
     
+def send_message(message: bytes, sock: socket.socket, prefix: bytes = b''):
+    if DEBUG:
+        sys.stderr.write('Sent: {}\n'.format(prefix + message))
+    sock.sendall(bytes_to_netstring(message, prefix))
     
-def receive_message_queue():
+    
+class NetstringReader:
     # stream-oriented
-    # closure
-    control_netstrings = b''
-    data_netstrings = b''
+    # one receive buffer per channel, the valid bytes are buffers[channel][:write_positions[channel]]
+    # the buffers are kept across messages and only ever grow
+    __slots__ = ('buffers', 'write_positions')
+    
+    def __init__(self):
+        self.buffers = (bytearray(RECEIVE_BUFFER_SIZE), bytearray(RECEIVE_BUFFER_SIZE))
+        self.write_positions = [0, 0]
     
     # channel: 0 for control channel, 1 for data channel
-    def inner(sock: socket.socket, channel: int) -> bytes:
-        nonlocal control_netstrings, data_netstrings
-        netstrings = control_netstrings if channel == 0 else data_netstrings
+    def read(self, sock: socket.socket, channel: int) -> bytes:
+        buf = self.buffers[channel]
+        write_pos = self.write_positions[channel]
+        # parse incrementally and return as soon as a complete netstring is buffered,
+        # only wait for more data (up to TIME_OUT) while the netstring is incomplete
+        # the colon and the length are parsed only once, scan_pos remembers how far
+        # the buffer has already been searched for the colon
+        colon = comma = -1
+        scan_pos = 0
         while True:
+            if colon == -1:
+                colon = buf.find(b':', scan_pos, write_pos)
+                if colon == -1:
+                    scan_pos = write_pos
+                else:
+                    length = buf[:colon]
+                    if buf[0] in b'0+':  # compares the byte value, no slice needed
+                        send_error(f'invalid netstring: {bytes(buf[:write_pos])}, startswith 0 or +', sock)
+                    if not length.isdigit():
+                        send_error(f'invalid netstring: {bytes(buf[:write_pos])}, invalid length', sock)
+                    try:
+                        comma = colon + 1 + int(length)
+                    except ValueError:  # more digits than int() accepts
+                        send_error(f'invalid netstring: {bytes(buf[:write_pos])}, invalid length', sock)
+            if colon != -1 and comma < write_pos:
+                break
+            
+            if len(buf) - write_pos < BUFFER_SIZE:
+                buf.extend(bytes(len(buf)))
             try:
-                data = sock.recv(BUFFER_SIZE)
-                sys.stderr.write(f'Received_segment: {data}\n')
-                if not data:
+                # receive directly into the buffer instead of concatenating bytes objects
+                with memoryview(buf) as view:
+                    received = sock.recv_into(view[write_pos:], BUFFER_SIZE)
+                if DEBUG:
+                    sys.stderr.write(f'Received_segment: {bytes(buf[write_pos:write_pos + received])}\n')
+                if not received:
                     break
-                netstrings += data
+                write_pos += received
             except socket.timeout:
                 break
         
-        sys.stderr.write(f'Netstrings: {netstrings}\n')
-        if netstrings == b'':
-            error = 'no netstring received'
-            sock.sendall(string_to_netstring(f'E {error}').encode())
-            print(f'Error: {error}')
-            sock.close()
-            sys.exit(1)
-        try:
-            length, data = netstrings.split(b':', 1)
-        except ValueError:
-            send_error(f'invalid netstring: {netstrings}, no colon', sock)
+        if DEBUG:
+            sys.stderr.write(f'Netstrings: {bytes(buf[:write_pos])}\n')
+        if write_pos == 0:
+            send_error('no netstring received', sock, 1)
+        if colon == -1:
+            send_error(f'invalid netstring: {bytes(buf[:write_pos])}, no colon', sock)
+        if write_pos <= comma or buf[comma] != 0x2c:  # b','
+            send_error(f'invalid netstring: {bytes(buf[:write_pos])}, no comma', sock)
             
-        if length.startswith(b'0') or length.startswith(b'+'):
-            send_error(f'invalid netstring: {netstrings}, startswith 0 or +', sock)
-        try:
-            length = int(length)
-        except ValueError:
-            send_error(f'invalid netstring: {netstrings}, invalid length', sock)
+        # slicing the memoryview avoids an intermediate bytearray copy
+        with memoryview(buf) as view:
+            message = bytes(view[colon + 1:comma])
+        # move whatever follows the consumed netstring to the front for the next call
+        keep = write_pos - (comma + 1)
+        if keep:
+            buf[:keep] = buf[comma + 1:write_pos]
+        self.write_positions[channel] = keep
         
-        if len(data) < length + 1 or data[length:length + 1] != b',':
-            send_error(f'invalid netstring: {netstrings}, no comma', sock)
-            
-        message = data[:length]
-        netstrings = data[length + 1:] if len(data) > length + 1 else b''
-        if channel == 0:
-            control_netstrings = netstrings
-        else:
-            data_netstrings = netstrings
-        
-        sys.stderr.write(f'Received: {message}\n')
+        if DEBUG:
+            sys.stderr.write(f'Received: {message}\n')
         if message is None:
             send_error(f'invalid netstring: {message}', sock)
-        if message.split(b' ')[0] == b'E':
-            send_error(message.split(b' ')[1].decode(), sock)
+        head, _, rest = message.partition(b' ')
+        if head == b'E':
+            send_error(rest.decode(errors='replace'), sock)
         return message
-    
-    return inner
 
-receive_message = receive_message_queue()
 
+receive_message = NetstringReader().read
 
-def build_data_channel(message: str, nick: str, dst_address: IPv6Address, data_channel: socket.socket, token):
+
+def build_data_channel(message_bytes: bytes, nick_bytes: bytes, dst_address: IPv6Address, data_channel: socket.socket, token):
     # Build the data channel with the server
     data_channel.listen(1)
-    sys.stderr.write('Listening on port {}\n'.format(data_channel.getsockname()[1]))
+    if DEBUG:
+        sys.stderr.write('Listening on port {}\n'.format(data_channel.getsockname()[1]))
     server_socket, server_address = data_channel.accept()
-    sys.stderr.write('Connected to {}\n'.format(server_address))
-    if server_address[0] != str(dst_address):
-        send_error('invalid server address: {}, expected: {}'.format(server_address[0], str(dst_address)), server_socket)
+    if DEBUG:
+        sys.stderr.write('Connected to {}\n'.format(server_address))
+    set_nodelay(server_socket)
+    # compare the binary addresses, the textual forms of one IPv6 address can differ
+    if IPv6Address(server_address[0]).packed != dst_address.packed:
+        send_error('invalid server address: {}, expected: {}'.format(server_address[0], dst_address), server_socket)
     server_socket.settimeout(TIME_OUT)
     
     data = receive_message(server_socket, 1)
-    if data != b'T GRNVS V:1.0':
+    if data != EXPECT_DATA_HELLO:
         send_error(f'invalid message: {data}, expected T GRNVS V:1.0', server_socket)
     
-    response = f'D {nick}'
-    send_message(response, server_socket)
+    send_message(b'D ' + nick_bytes, server_socket)
     
+    # E messages are already handled by receive_message
     data = receive_message(server_socket, 1)
-    try:
-        begin, received_token = data.split(b' ')
-        if begin == b'E':
-            send_error(received_token, server_socket)
-        elif begin != b'T' or received_token != token:
-            raise ValueError
-    except:
+    if data != b'T ' + token:
         send_error(f'invalid message: {data}, expected T {token}', server_socket)
     
-    response = f'D {message}'
-    send_message(response, server_socket)
+    # the message may be a whole file, frame 'D <message>' without an extra copy
+    send_message(message_bytes, server_socket, prefix=b'D ')
     
     data = receive_message(server_socket, 1)
     server_socket.close()
     return data
 
 
-def run(port: int, message: str, nick: str, dst_address: IPv6Address):
+def run(port: int, message_bytes: bytes, nick: str, dst_address: IPv6Address):
     # With Python, you can use almost the same socket interface as in C
     # Have a look at https://docs.python.org/3/library/socket.html
 
     # Build the control channel
     with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as control_channel:
+        configure_socket(control_channel)
         control_channel.connect((str(dst_address), port))
         control_channel.settimeout(TIME_OUT)
         
-        init_sequence = 'C GRNVS V:1.0'
-        send_message(init_sequence, control_channel)
+        send_netstring(INIT_NETSTRING, control_channel)
         
         response = receive_message(control_channel, 0)
-        if response != b'S GRNVS V:1.0':
+        if response != EXPECT_SERVER_HELLO:
             send_error(f'invalid message: {response}, expected S GRNVS V:1.0', control_channel)
         
-        send_message(f'C {nick}', control_channel)
+        # the nick is fixed for the whole run, encode it only once
+        nick_bytes = nick.encode()
+        send_message(b'C ' + nick_bytes, control_channel)
         
         response = receive_message(control_channel, 0)
-        try:
-            begin, token = response.split(b' ', 1)  # split only once
-            if begin == b'E':
-                send_error(token, control_channel)
-            elif begin != b'S':
-                raise ValueError
-        except:
+        parts = response.split(b' ', 1)  # split only once
+        if len(parts) != 2 or parts[0] != b'S':
             send_error(f'invalid message: {response}, expected S <token>', control_channel)
+        token = parts[1]
         
         # Open an available port
         with socket.socket(socket.AF_INET6, socket.SOCK_STREAM) as data_channel:
+            # accepted sockets inherit the buffer sizes of this listening socket
+            configure_socket(data_channel)
             data_channel.bind(('', 0))
             # print(data_channel.getsockname())
             dport = data_channel.getsockname()[1]
             
-            send_message(f'C {dport}', control_channel)
+            send_message(b'C %d' % dport, control_channel)
             
             # Build the data channel
-            dtoken_data = build_data_channel(message, nick, dst_address, data_channel, token)
-            try:
-                # token may contain '\n', ' ' and non-utf8 characters
-                begin, dtoken = dtoken_data.split(b' ', 1)  # split only once
-                if begin == b'E':
-                    send_error(dtoken, control_channel)
-                elif begin != b'T':
-                    raise ValueError
-            except:
+            dtoken_data = build_data_channel(message_bytes, nick_bytes, dst_address, data_channel, token)
+            # token may contain '\n', ' ' and non-utf8 characters
+            parts = dtoken_data.split(b' ', 1)  # split only once
+            if len(parts) != 2 or parts[0] != b'T':
                 send_error(f'invalid message: {dtoken_data}, expected T <token>', control_channel)
+            dtoken = parts[1]
         
+        data = receive_message(control_channel, 0)
         try:  # utf-8
-            data = receive_message(control_channel, 0)
             data = data.decode()
         except UnicodeDecodeError:
             send_error(f'invalid utf-8 message: {data}', control_channel)
-        try:
-            begin, msglen = data.split(' ')
-            if begin != 'S':
-                raise ValueError
-            msglen = string_to_int(msglen)
-            if msglen is None:
-                raise ValueError
-        except:
+        parts = data.split(' ')
+        msglen = string_to_int(parts[1]) if len(parts) == 2 and parts[0] == 'S' else None
+        if msglen is None:
             send_error(f'invalid message: {data}, expected S <msglen>', control_channel)
         
-        if msglen != len(message.encode()):
-            send_error('wrong message length: {}, expected: {}'.format(msglen, len(message.encode())), control_channel)
+        if msglen != len(message_bytes):
+            send_error('wrong message length: {}, expected: {}'.format(msglen, len(message_bytes)), control_channel)
         
-        sent_bytes = 'C '.encode() + dtoken
-        sys.stderr.write(f'Sent: {sent_bytes}\n')
-        control_channel.sendall(str(len(sent_bytes)).encode() + b':' + sent_bytes + b',')
+        send_message(b'C ' + dtoken, control_channel)
         
         data = receive_message(control_channel, 0)
-        if data != b'S ACK':
+        if data != EXPECT_ACK:
             send_error(f'invalid message: {data}, expected S ACK', control_channel)
     
 
@@ -231,15 +266,21 @@ def run(port: int, message: str, nick: str, dst_address: IPv6Address):
 @click.option('-p', '--port', type=click.IntRange(min=1, max=2 ** 16, max_open=True), default=1337, help='the port the client should connect to')
 @click.option('-m', '--message', type=str, help='the message to send, spaces might need to be quoted in the shell')
 @click.option('-f', '--file', type=click.Path(exists=True, dir_okay=False, path_type=pathlib.Path), help='a file to use as message, -m will be ignored')
+@click.option('-v', '--verbose', is_flag=True, help='print sent and received messages to stderr')
 @click.argument('nick', type=str, required=True)  # the nick that should be displayed on the server
 @click.argument('destination', type=str, required=True)  # the destination IPv6 address
-def main(port: int, message: str, file: pathlib.Path, nick: str, destination: str):
+def main(port: int, message: str, file: pathlib.Path, verbose: bool, nick: str, destination: str):
+    global DEBUG
+    DEBUG = verbose
     if not file and not message:
         raise SystemExit("-m <message> or -f <file> must be given!")
+    # the message is sent as raw bytes, a file never needs to be decoded
     if file:
-        message = file.read_text()
+        message_bytes = file.read_bytes()
+    else:
+        message_bytes = message.encode()
     dst_address = ipaddress.IPv6Address(destination)
-    run(port, message, nick, dst_address)
+    run(port, message_bytes, nick, dst_address)
 
 
 if __name__ == '__main__':